@@ -1,33 +1,36 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import json
+import shutil
 import subprocess
 import os
 import tempfile
 import sys
 from typing import Optional, Tuple
 
+IDENTIFY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'videoforge', 'mkv_identify')
+
 def check_mkvtoolnix_installed() -> None:
     """Check if required mkvtoolnix commands are available."""
-    for cmd in ['mkvmerge', 'mkvpropedit', 'mkvinfo']:
-        if not any(os.path.exists(os.path.join(path, cmd))
-                  for path in os.environ["PATH"].split(os.pathsep)):
+    for cmd in ['mkvmerge', 'mkvpropedit']:
+        if shutil.which(cmd) is None:
             print(f"Error: {cmd} is not installed. Please install mkvtoolnix first.")
             sys.exit(1)
 
-def run_command(cmd: list[str], check: bool = True) -> Tuple[str, str]:
-    """Run a command and return stdout and stderr."""
+def run_command(cmd: list[str], check: bool = True) -> Tuple[bytes, bytes]:
+    """Run a command and return raw stdout and stderr; decode only what is printed."""
     try:
         result = subprocess.run(
             cmd,
             check=check,
-            text=True,
             capture_output=True
         )
         return result.stdout, result.stderr
     except subprocess.CalledProcessError as e:
         print(f"Error running command: {' '.join(cmd)}")
-        print(f"Error output: {e.stderr}")
+        print(f"Error output: {e.stderr.decode('utf-8', errors='replace')}")
         sys.exit(1)
 
 class Track:
@@ -40,48 +43,111 @@ class Track:
     def __str__(self):
         return f"Track ID {self.track_id}: {self.type} ({self.language}) [{self.codec}]"
 
-def parse_tracks(mkv_file: str) -> list[Track]:
-    """Parse track information from mkvinfo output."""
-    stdout, _ = run_command(['mkvinfo', mkv_file])
+def _identify_cache_path(path: str) -> str:
+    """Return the cache file for a path; each path has at most one entry."""
+    digest = hashlib.sha256(path.encode()).hexdigest()
+    return os.path.join(IDENTIFY_CACHE_DIR, f"{digest}.json")
 
-    tracks = []
-    current_track = {'track_id': '', 'track_type': '', 'language': 'undefined', 'codec': ''}
-
-    for line in stdout.split('\n'):
-        line = line.strip()
-        if '|  + Track number:' in line:
-            if current_track['track_id']:
-                tracks.append(Track(**current_track))
-                current_track = {'track_id': '', 'track_type': '', 'language': 'undefined', 'codec': ''}
-            # Extract track ID from format: "Track number: 1 (track ID for mkvmerge & mkvextract: 0)"
-            track_id_match = line.split('mkvextract:')[1].strip()
-            current_track['track_id'] = track_id_match.rstrip(')')
-        elif '|  + Track type:' in line:
-            current_track['track_type'] = line.split(':')[1].strip()
-        elif '|  + Codec ID:' in line:
-            current_track['codec'] = line.split(':')[1].strip()
-        elif '|  + Language:' in line and 'IETF' not in line:
-            current_track['language'] = line.split(':')[1].strip()
-
-    if current_track['track_id']:
-        tracks.append(Track(**current_track))
+def _stat_signature(stat: os.stat_result) -> list[int]:
+    """Fields that must all match for a cached identification to be reused."""
+    # ctime and inode catch a different file copied in with the same size and mtime
+    return [stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size, stat.st_ino]
+
+def identify(mkv_file: str, stat: Optional[os.stat_result] = None) -> dict:
+    """Return mkvmerge's JSON identification of a file (tracks and container properties)."""
+    if stat is None:
+        stat = os.stat(mkv_file)
+    path = os.path.abspath(mkv_file)
+    signature = _stat_signature(stat)
+    cache_file = _identify_cache_path(path)
+    try:
+        with open(cache_file, 'rb') as f:
+            entry = json.load(f)
+        if entry['path'] == path and entry['stat'] == signature:
+            return entry['info']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
 
+    stdout, _ = run_command(['mkvmerge', '-J', path])
+    info = json.loads(stdout)
+
+    # Overwrite this path's entry atomically; a failure to cache is not fatal
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(IDENTIFY_CACHE_DIR, exist_ok=True)
+        with open(temp_file, 'w') as f:
+            json.dump({'path': path, 'stat': signature, 'info': info}, f)
+        os.replace(temp_file, cache_file)
+    except OSError:
+        try:
+            remove_if_exists(temp_file)
+        except OSError:
+            pass
+    return info
+
+def parse_tracks(info: dict) -> list[Track]:
+    """Build Track objects from mkvmerge identification output."""
+    tracks = []
+    for track in info.get('tracks', []):
+        properties = track.get('properties', {})
+        tracks.append(Track(
+            track_id=str(track['id']),
+            track_type=track['type'],
+            language=properties.get('language', 'undefined'),
+            codec=properties.get('codec_id', track.get('codec', ''))
+        ))
     return tracks
 
+def get_temp_dir(file: str, expected_size: int) -> str:
+    """Pick a directory for the rewritten file, preferring the (often RAM-backed) temp dir."""
+    temp_dir = tempfile.gettempdir()
+    if shutil.disk_usage(temp_dir).free < expected_size * 1.1:
+        return os.path.dirname(os.path.abspath(file))
+    return temp_dir
+
+def remove_if_exists(path: str) -> None:
+    """Remove a leftover temporary file, ignoring it if already gone."""
+    if os.path.exists(path):
+        os.remove(path)
+
+def replace_file(temp_file: str, file: str) -> None:
+    """Replace file with temp_file, staging it next to file first if it lives elsewhere."""
+    file_dir = os.path.dirname(os.path.abspath(file))
+    if os.path.dirname(temp_file) == file_dir:
+        os.replace(temp_file, file)
+        return
+
+    # Cross-filesystem moves copy, so keep the final swap an atomic rename
+    fd, local_temp = tempfile.mkstemp(dir=file_dir, suffix='.mkv')
+    os.close(fd)
+    try:
+        shutil.move(temp_file, local_temp)
+        os.replace(local_temp, file)
+    finally:
+        remove_if_exists(local_temp)
+
 def process_mkv_file(file: str, delete_subtitles: bool, keep_language: Optional[str], dry_run: bool) -> None:
     """Process an MKV file according to specified options."""
-    if not os.path.exists(file):
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
         print(f"File '{file}' not found.")
         return
 
     print(f"Tracks in '{file}':")
     print("-" * 40)
 
-    tracks = parse_tracks(file)
+    info = identify(file, stat)
+    tracks = parse_tracks(info)
     for track in tracks:
         print(track)
     print("-" * 40)
 
+    # Work out every required change up front so no-op runs never rewrite the file
+    needs_audio_filter = False
+    needs_subtitle_strip = False
+    audio_track_ids = ''
+
     # Process audio tracks if keep_language is specified
     if keep_language:
         print(f"Analyzing audio tracks in '{file}'...")
@@ -101,25 +167,7 @@ def process_mkv_file(file: str, delete_subtitles: bool, keep_language: Optional[
                 print(f"Warning: No {keep_language} audio tracks found. Keeping all audio tracks.")
             else:
                 audio_track_ids = ','.join(t.track_id for t in target_tracks)
-                if dry_run:
-                    print(f"Would keep only {keep_language} audio tracks in '{file}'.")
-                else:
-                    temp_file = f"{os.path.splitext(file)[0]}_{keep_language}.mkv"
-                    cmd = ['mkvmerge', '-o', temp_file, '--video-tracks', '0',
-                          '--audio-tracks', audio_track_ids, file]
-                    run_command(cmd)
-
-                    # Check output file size
-                    original_size = os.path.getsize(file)
-                    new_size = os.path.getsize(temp_file)
-
-                    if new_size > original_size / 2:
-                        os.replace(temp_file, file)
-                        print(f"Kept only {keep_language} audio tracks in '{file}'.")
-                    else:
-                        print("Error: Output file is suspiciously small. Operation aborted.")
-                        os.remove(temp_file)
-                        sys.exit(1)
+                needs_audio_filter = True
         else:
             print("No audio track changes needed.")
 
@@ -130,31 +178,67 @@ def process_mkv_file(file: str, delete_subtitles: bool, keep_language: Optional[
             print(f"No subtitles found in '{file}'.")
         else:
             print(f"Subtitles found in '{file}'.")
-            if dry_run:
-                print(f"Would remove all subtitles from '{file}'.")
-            else:
-                temp_file = f"{os.path.splitext(file)[0]}_no_subtitles.mkv"
-                run_command(['mkvmerge', '-o', temp_file, '--no-subtitles', file])
-                os.replace(temp_file, file)
-                print(f"All subtitles removed from '{file}'.")
+            needs_subtitle_strip = True
 
-    # Update title if needed
     title = os.path.splitext(os.path.basename(file))[0]
-    stdout, _ = run_command(['mkvinfo', file])
-    current_title = None
-    for line in stdout.split('\n'):
-        if '|  + Title:' in line:
-            current_title = line.split(':')[1].strip()
-            break
-
-    if current_title != title:
+    current_title = info.get('container', {}).get('properties', {}).get('title')
+    needs_title_change = current_title != title
+
+    needs_rewrite = needs_audio_filter or needs_subtitle_strip
+
+    if needs_rewrite:
+        # Rewrite the file once, setting the title as part of the same pass
         if dry_run:
-            print(f"Would set the title of '{file}' to '{title}'.")
+            if needs_audio_filter:
+                print(f"Would keep only {keep_language} audio tracks in '{file}'.")
+            if needs_subtitle_strip:
+                print(f"Would remove all subtitles from '{file}'.")
         else:
-            run_command(['mkvpropedit', file, '--edit', 'info', '--set', f'title={title}'])
-            print(f"Set the title of '{file}' to '{title}'.")
-    else:
+            fd, temp_file = tempfile.mkstemp(prefix=f"{title}_", suffix='.mkv',
+                                             dir=get_temp_dir(file, stat.st_size))
+            os.close(fd)
+            cmd = ['mkvmerge', '-o', temp_file, '--title', title]
+            if needs_audio_filter:
+                cmd += ['--video-tracks', '0', '--audio-tracks', audio_track_ids]
+            if needs_subtitle_strip:
+                cmd.append('--no-subtitles')
+            cmd.append(file)
+
+            # Don't leave partial output behind (possibly on tmpfs) if anything fails
+            try:
+                run_command(cmd)
+
+                # Check output file size against the stat taken on entry
+                original_size = stat.st_size
+                new_size = os.path.getsize(temp_file)
+
+                if needs_audio_filter and new_size <= original_size / 2:
+                    print("Error: Output file is suspiciously small. Operation aborted.")
+                    sys.exit(1)
+
+                # mkstemp creates 0600 files; match the source, but only once
+                # mkvmerge is done writing (a read-only source would block it)
+                os.chmod(temp_file, stat.st_mode & 0o777)
+                replace_file(temp_file, file)
+            finally:
+                remove_if_exists(temp_file)
+            if needs_audio_filter:
+                print(f"Kept only {keep_language} audio tracks in '{file}'.")
+            if needs_subtitle_strip:
+                print(f"All subtitles removed from '{file}'.")
+    elif needs_title_change and not dry_run:
+        # No rewrite needed, so update the title in place
+        run_command(['mkvpropedit', file, '--edit', 'info', '--set', f'title={title}'])
+
+    # Report the title once, whichever path (if any) updated it
+    if not (needs_rewrite or needs_title_change):
+        print(f"No changes required for '{file}'.")
+    elif not needs_title_change:
         print(f"The title of '{file}' already matches the filename. No change needed.")
+    elif dry_run:
+        print(f"Would set the title of '{file}' to '{title}'.")
+    else:
+        print(f"Set the title of '{file}' to '{title}'.")
 
     print()
 